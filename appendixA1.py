@@ -4,10 +4,15 @@ import bpy
 object_name = 'Cube'
 
 o = bpy.data.objects[object_name]
-normals = [p.normal for p in o.data.polygons]
 
 import numpy as np
-resultant_normal = np.add.reduce(normals)
+# copying all polygon normals in a single call instead of iterating polygons in python
+n = len(o.data.polygons)
+normals = np.empty(n * 3, dtype=np.float32)
+o.data.polygons.foreach_get('normal', normals)
+normals = normals.reshape(n, 3)
 
-magnitude = np.linalg.norm(resultant_normal)
+resultant_normal = normals.sum(axis=0)
+
+magnitude = np.sqrt(resultant_normal @ resultant_normal)
 unit_vector = resultant_normal / magnitude
\ No newline at end of file
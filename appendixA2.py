@@ -3,8 +3,8 @@
 Constraints: 
 1. If a node on one surface has more then one closest node on the other surface then it will form the pair with 
 the least distant node others will be ignored see test case 3
-2. Rounding off threshold and least distance values to 5 decimal places to avoid computational precision
-error
+2. Comparing squared least distances with squared threshold within a relative tolerance of a few single precision 
+ulps so that distances equal up to precision error of the coordinates qualify alike, whatever the units of the mesh
 
 Author: Saad Ahmed Khan
 Email: s.aad@live.com
@@ -14,6 +14,24 @@ Email: s.aad@live.com
 import numpy as np
 # needs to be install separately. https://blender.stackexchange.com/a/122337/83435
 import pandas as pd
+# optional, needs to be install separately like pandas. used for k-d tree nearest node search
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+# optional, needs to be install separately like pandas. used for compiling brute force search
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+# optional, needs to be install separately like pandas. used for pairwise distances on GPU
+try:
+    import cupy as cp
+    # import succeeds on machines without a CUDA device or driver
+    if cp.cuda.runtime.getDeviceCount() == 0:
+        cp = None
+except (ImportError, RuntimeError):
+    cp = None
 # blender python API
 import bpy
 C = bpy.context
@@ -27,10 +45,31 @@ a contact
 samplesize = 7000
 selected_objects = C.selected_objects
 
+# search method for closest nodes. 'auto' uses the fastest one available, 'convolution' forces circular convolution
+method = 'auto'
+# minimum no of node pairs for searching closest nodes on GPU, below it launch and transfer overhead outweighs the gain.
+# unmeasured default, tune it on the target GPU. the search runs in double precision which is much slower than single 
+# precision on consumer GPUs
+device_limit = 1000000000
+# minimum no of node pairs for which compiling the brute force search pays off. compiling takes about 0.8 s on every 
+# blender session and then searches about 7e8 pairs/s against about 4e8 pairs/s by blocked pairwise distances, so it 
+# breaks even around 1e9 pairs
+compile_limit = 1000000000
+
 def separateCoordinates(obj):
-    ''' returns a list of tuples with object's vertex's coordinates and respective index
+    ''' returns object's vertex's world coordinates as single precision (n, 3) array and respective indexes
     '''
-    return [(obj.matrix_world * v.co, v.index) for v in obj.data.vertices]
+    n = len(obj.data.vertices)
+    # local coordinates copied in a single call instead of iterating vertices in python
+    co = np.empty(n * 3, dtype=np.float32)
+    obj.data.vertices.foreach_get('co', co)
+    co = co.reshape(n, 3)
+
+    # transforming all coordinates to world space at once
+    matrix = np.array(obj.matrix_world)
+    co = (co @ matrix[:3, :3].T + matrix[:3, 3]).astype(np.float32)
+    idx = np.arange(n, dtype=np.int32)
+    return co, idx
 
 def addToGroup(obj, vertices):
     ''' add vertices to object 
@@ -39,6 +78,156 @@ def addToGroup(obj, vertices):
     '''
     obj.vertex_groups.new(name='contact').add(vertices, 1.0, 'ADD')
 
+def circularConvolution(small_co, large_co):
+    ''' brute force search for the closest node in large coordinates array for each node in small coordinates array
+    @param small_co - coordinates of object with less vertices
+    @param large_co - coordinates of object with more vertices
+    returns closest node indexes in large coordinates array
+    '''
+    # no of iterations required to calculate distance between all points in small and large coordinates array
+    absdiff = len(large_co) - len(small_co)
+    iterations = len(small_co) + absdiff - 1
+
+    # ring of large object's indexes repeated twice for circular convolution. slicing it at an offset gives the large 
+    # objects coordinates array rolled by that offset without copying
+    ring = np.concatenate([np.arange(len(large_co))] * 2)
+
+    # limit for resizing large coordinates array equal to small coordinates array
+    limit = len(large_co) - absdiff
+
+    # dynamic pointer for sorting by small object's coordinates array such that coordinates at the same index are the closest
+    # pair nodes. every node is updated by the first iteration since least distances start at infinity
+    dynamic_pointer = np.empty(limit, dtype=ring.dtype)
+    leastdists_sq = np.full(limit, np.inf, dtype=small_co.dtype)
+
+    # buffers reused by every iteration
+    large_co_resized = np.empty_like(small_co)
+    diff = np.empty_like(small_co)
+    new_sq = np.empty_like(leastdists_sq)
+    mask = np.empty(limit, dtype=bool)
+
+    for i in range(iterations + 1):
+        # rolled indexes for circular convolution
+        rolling_pointer_resized = ring[i:i + limit]
+        # indexes from ring are always in range. clip mode lets take write straight into the buffer, the default mode 
+        # copies it for bounds checks
+        np.take(large_co, rolling_pointer_resized, axis=0, out=large_co_resized, mode='clip')
+        # applying distance formula. squared distances are compared since square root does not change the order
+        np.subtract(small_co, large_co_resized, out=diff)
+        np.einsum('ij,ij->i', diff, diff, out=new_sq)
+
+        # perpare mask where new least distances are found
+        np.less(new_sq, leastdists_sq, out=mask)
+        # update dynamic pointer where new least distances are found, without branching on the mask
+        np.copyto(dynamic_pointer, rolling_pointer_resized, where=mask)
+        # update distance with new least distances
+        np.minimum(leastdists_sq, new_sq, out=leastdists_sq)
+
+    return dynamic_pointer
+
+def denseDistances(small_co, large_co, block_rows=128, block_cols=1024, xp=np):
+    ''' brute force search for the closest node in large coordinates array for each node in small coordinates array
+    using pairwise distances. |q - p|^2 is expanded to q.q + p.p - 2 q.p so that the cross term is a matrix product. 
+    pairwise distances are computed in blocks small enough to stay in cache and reduced to running least distances, so 
+    that the whole pairwise distance matrix is never held in memory
+    @param small_co - coordinates of object with less vertices
+    @param large_co - coordinates of object with more vertices
+    @param block_rows - no of small object's nodes in a block
+    @param block_cols - no of large object's nodes in a block
+    @param xp - array module the search runs on, numpy or cupy
+    returns closest node indexes in large coordinates array
+    '''
+    # expanded form loses precision to cancellation in single precision
+    small_co, large_co = xp.asarray(small_co, dtype=xp.float64), xp.asarray(large_co, dtype=xp.float64)
+    q2 = xp.einsum('ij,ij->i', small_co, small_co)
+    p2 = xp.einsum('ij,ij->i', large_co, large_co)
+
+    dynamic_pointer = xp.empty(len(small_co), dtype=xp.intp)
+    rows = xp.arange(block_rows)
+
+    for i in range(0, len(small_co), block_rows):
+        small_block = small_co[i:i + block_rows]
+        block_pointer = xp.zeros(len(small_block), dtype=xp.intp)
+        block_leastdists_sq = xp.full(len(small_block), xp.inf)
+
+        for j in range(0, len(large_co), block_cols):
+            # squared distances between nodes in the block, rows are small object's nodes and columns are large 
+            # object's nodes
+            dists_sq = small_block @ large_co[j:j + block_cols].T
+            dists_sq *= -2
+            dists_sq += p2[j:j + block_cols]
+            dists_sq += q2[i:i + block_rows, None]
+
+            # update running least distances where the block has closer nodes, earlier blocks win ties
+            pointer = dists_sq.argmin(axis=1)
+            new_sq = dists_sq[rows[:len(small_block)], pointer]
+            mask = new_sq < block_leastdists_sq
+            xp.copyto(block_pointer, pointer + j, where=mask)
+            xp.minimum(block_leastdists_sq, new_sq, out=block_leastdists_sq)
+
+        dynamic_pointer[i:i + block_rows] = block_pointer
+
+    return dynamic_pointer
+
+def deviceDistances(small_co, large_co, block_rows=2048, block_cols=8192):
+    ''' brute force search on GPU for the closest node in large coordinates array for each node in small coordinates 
+    array. same blocked search as denseDistances run on device with larger blocks to keep the GPU busy. it stays in 
+    double precision, even with coordinates centred single precision picks different closest nodes among near ties
+    @param small_co - coordinates of object with less vertices
+    @param large_co - coordinates of object with more vertices
+    @param block_rows - no of small object's nodes in a block
+    @param block_cols - no of large object's nodes in a block
+    returns closest node indexes in large coordinates array
+    '''
+    return denseDistances(small_co, large_co, block_rows, block_cols, cp).get()
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True)
+    def compiledDistances(small_co, large_co, dynamic_pointer):
+        ''' compiled brute force search for the closest node in large coordinates array for each node in small 
+        coordinates array. nodes of small object are searched in parallel
+        @param small_co - contiguous coordinates of object with less vertices
+        @param large_co - contiguous coordinates of object with more vertices
+        @param dynamic_pointer - output, closest node indexes in large coordinates array
+        '''
+        for i in prange(small_co.shape[0]):
+            # starting from the first node since fastmath assumes there are no infinities
+            best_j = 0
+            best_d = ((small_co[i, 0] - large_co[0, 0]) ** 2 + (small_co[i, 1] - large_co[0, 1]) ** 2 + 
+                (small_co[i, 2] - large_co[0, 2]) ** 2)
+            for j in range(1, large_co.shape[0]):
+                d = ((small_co[i, 0] - large_co[j, 0]) ** 2 + (small_co[i, 1] - large_co[j, 1]) ** 2 + 
+                    (small_co[i, 2] - large_co[j, 2]) ** 2)
+                if d < best_d:
+                    best_j, best_d = j, d
+            dynamic_pointer[i] = best_j
+
+def nearestNodes(small_co, large_co):
+    ''' returns closest node indexes in large coordinates array for each node in small coordinates array, distances are 
+    computed by the caller from the pairs. uses k-d tree when scipy is available, blocked pairwise distances on GPU 
+    when cupy finds a device and there are at least device_limit node pairs, compiled search when numba is available 
+    and there are at least compile_limit node pairs otherwise blocked pairwise distances. circular convolution is used 
+    when set by method
+    @param small_co - coordinates of object with less vertices
+    @param large_co - coordinates of object with more vertices
+    '''
+    if method == 'convolution':
+        return circularConvolution(small_co, large_co)
+
+    if cKDTree is not None:
+        _, dynamic_pointer = cKDTree(large_co).query(small_co, k=1, workers=-1)
+        return dynamic_pointer
+
+    if cp is not None and len(small_co) * len(large_co) >= device_limit:
+        return deviceDistances(small_co, large_co)
+
+    if njit is not None and len(small_co) * len(large_co) >= compile_limit:
+        dynamic_pointer = np.empty(len(small_co), dtype=np.intp)
+        compiledDistances(np.ascontiguousarray(small_co), np.ascontiguousarray(large_co), dynamic_pointer)
+        return dynamic_pointer
+
+    return denseDistances(small_co, large_co)
+
 def main(samplesize_ = samplesize, selected_objects_ = selected_objects):
     ''' main driver function for generating contact
     References 
@@ -52,69 +241,30 @@ def main(samplesize_ = samplesize, selected_objects_ = selected_objects):
 
     # assuming first seleted is larger that is, has more vertices then the second
     large_obj, small_obj = selected_objects_[0], selected_objects_[1]
-    separated1 = separateCoordinates(large_obj)
-    separated2 = separateCoordinates(small_obj)
-    large_co, large_v = zip(*separated1)
-    small_co, small_v = zip(*separated2)
+    large_co, large_v = separateCoordinates(large_obj)
+    small_co, small_v = separateCoordinates(small_obj)
 
     # checking assumption
-    diff = len(separated1) - len(separated2)
+    diff = len(large_co) - len(small_co)
     if diff < 0:
         large_obj, small_obj = small_obj, large_obj
         large_co, small_co = small_co, large_co
         large_v, small_v = small_v, large_v
 
-    # converting coordinates to numpy array
-    small_co = np.array(small_co)
-    large_co = np.array(large_co)
+    # index of the closest node in large coordinates array for each node in small coordinates array
+    dynamic_pointer = nearestNodes(small_co, large_co)
 
-    # no of iterations required to calculate distance between all points in small and large coordinates array
-    absdiff = abs(diff)
-    iterations = len(small_co) + absdiff - 1
+    # squared distances of the closest pairs in double precision so that they are the same for every search method
+    paired = small_co.astype(np.float64) - large_co[dynamic_pointer]
+    leastdists_sq = np.einsum('ij,ij->i', paired, paired)
 
-    # rolling pointer for circular convolution. it will roll large objects coordinates array at each iteration. 
-    # all items will be pushed to the next index and the last item will be pushed to first
-    rolling_pointer = np.arange(len(large_co))
-    # dynamic pointer for sorting by small object's coordinates array such that coordinates at the same index are the closest
-    # pair nodes
-    dynamic_pointer = np.copy(rolling_pointer)
-
-    # limit for resizing large coordinates array equal to small coordinates array
-    limit = len(large_co) - absdiff
-
-    # initial iteration
-    rolling_pointer_resized = rolling_pointer[:limit]
-    large_co_resized = large_co[rolling_pointer_resized]
-
-    # np.linalg.norm - applying distance formula
-    leastdists = np.linalg.norm(small_co - large_co_resized, axis=1)
-
-    for i in range(iterations):
-        # rolling indexes for circular convolution
-        rolling_pointer = np.roll(rolling_pointer, -1)
-
-        # next iteration
-        rolling_pointer_resized = rolling_pointer[:limit]
-        large_co_resized = large_co[rolling_pointer_resized]
-        new = np.linalg.norm(small_co - large_co_resized, axis=1)
-
-        # perpare mask where new least distances are found
-        mask = new < leastdists
-        # check if new distances are found
-        if np.any(mask):
-            # update dynamic pointer where new least distances are found
-            dynamic_pointer[:limit][mask] = rolling_pointer_resized[mask]
-            # update distance with new least distances
-            leastdists[mask] = new[mask]    
-
-    threshold = np.amax(np.sort(leastdists)[:samplesize_])
-    
-    # rounding to avoid precision error
-    threshold = round(threshold, 5)
-    leastdists = np.array([round(dist, 5) for dist in leastdists])
+    # squared distance of the samplesize-th least distant pair. partial sort since only that element is needed
+    kth = min(samplesize_, len(leastdists_sq)) - 1
+    threshold_sq = np.partition(leastdists_sq, kth)[kth]
     
-    # prepare mask for least distances which qualify as contancting nodes
-    mask = leastdists <= threshold
+    # prepare mask for least distances which qualify as contancting nodes. relative tolerance tied to single precision 
+    # coordinates to avoid precision error independent of mesh units
+    mask = leastdists_sq <= threshold_sq * (1 + 4 * np.finfo(np.float32).eps)
     
     # converting vertices indexes for numpy operations
     large_v_np = np.array(large_v)
@@ -122,7 +272,7 @@ def main(samplesize_ = samplesize, selected_objects_ = selected_objects):
 
     # dynamic pointer sorted by small object's coordinates array such that coordinates at the same index are the closest
     # pair nodes
-    dynamic_pointer_sorted = dynamic_pointer[:limit][mask]
+    dynamic_pointer_sorted = dynamic_pointer[mask]
     
     # slicing into vertices pairs
     large_v_np = large_v_np[dynamic_pointer_sorted]
@@ -133,9 +283,9 @@ def main(samplesize_ = samplesize, selected_objects_ = selected_objects):
     data = {
         "small_v_np" : small_v_np,
         "large_v_np" : large_v_np,
-        "leastdists" : leastdists[mask]
+        "leastdists_sq" : leastdists_sq[mask]
     }
-    sorted = pd.DataFrame(data).sort_values(["large_v_np","leastdists"])
+    sorted = pd.DataFrame(data).sort_values(["large_v_np","leastdists_sq"])
     grouped = sorted.groupby(["large_v_np"])
     df = grouped.first().reset_index()
 
@@ -152,14 +302,11 @@ def main(samplesize_ = samplesize, selected_objects_ = selected_objects):
     addToGroup(small_obj, small_v_list)
 
     if(TESTING):
-        # slicing into coordinates pairs
-        small_co = small_co[mask]
-        large_co = large_co[dynamic_pointer_sorted]
-        dists = np.linalg.norm(small_co - large_co, axis=1)
+        # distances rounded off for comparing with expected values
         return {
             "length" : len(large_v_list),
-            "threshold" : threshold,
-            "dists" : [round(dist, 5) for dist in dists]
+            "threshold" : np.round(np.sqrt(threshold_sq), 5),
+            "dists" : np.round(np.sqrt(leastdists_sq[mask]), 5).tolist()
         }
 
 TESTING = False